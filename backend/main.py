@@ -1,5 +1,5 @@
-from typing import List
-from fastapi import FastAPI, Depends, HTTPException
+from typing import List, Optional
+from fastapi import FastAPI, Depends, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 from . import schemas
 # from .database import engine, Base, get_db
@@ -21,6 +21,15 @@ app.add_middleware(
 def read_root():
     return {"message": "Welcome to Product Management Queen API (Google Sheets Edition)"}
 
+def parse_if_match(if_match: Optional[str]):
+    """Set of strong ETags from an If-Match header, or None when any version is acceptable"""
+    # "*" (or no header) means "any current version"
+    if if_match is None or if_match.strip() == "*":
+        return None
+    # If-Match uses strong comparison, so weak tags (W/"...") can never match
+    tags = [tag.strip() for tag in if_match.split(",")]
+    return {tag.strip('"') for tag in tags if tag and not tag.startswith("W/")}
+
 # Ingredient Endpoints
 @app.post("/ingredients/", response_model=schemas.Ingredient)
 def create_ingredient(ingredient: schemas.IngredientCreate):
@@ -31,10 +40,14 @@ def read_ingredients():
     return sheets.db.get_ingredients()
 
 @app.put("/ingredients/{ingredient_id}", response_model=schemas.Ingredient)
-def update_ingredient(ingredient_id: int, ingredient: schemas.IngredientCreate):
-    updated_ingredient = sheets.db.update_ingredient(ingredient_id, ingredient)
+def update_ingredient(ingredient_id: int, ingredient: schemas.IngredientCreate, response: Response, if_match: Optional[str] = Header(None)):
+    try:
+        updated_ingredient = sheets.db.update_ingredient(ingredient_id, ingredient, expected_versions=parse_if_match(if_match))
+    except sheets.VersionConflict:
+        raise HTTPException(status_code=412, detail="Ingredient was modified by someone else")
     if updated_ingredient is None:
         raise HTTPException(status_code=404, detail="Ingredient not found")
+    response.headers["ETag"] = f'"{updated_ingredient.version}"'
     return updated_ingredient
 
 # Recipe Endpoints
@@ -47,17 +60,22 @@ def read_recipes():
     return sheets.db.get_recipes()
 
 @app.get("/recipes/{recipe_id}", response_model=schemas.Recipe)
-def read_recipe(recipe_id: int):
+def read_recipe(recipe_id: int, response: Response):
     recipe = sheets.db.get_recipe(recipe_id)
     if recipe is None:
         raise HTTPException(status_code=404, detail="Recipe not found")
+    response.headers["ETag"] = f'"{recipe.version}"'
     return recipe
 
 @app.put("/recipes/{recipe_id}", response_model=schemas.Recipe)
-def update_recipe(recipe_id: int, recipe: schemas.RecipeCreate):
-    updated_recipe = sheets.db.update_recipe(recipe_id, recipe)
+def update_recipe(recipe_id: int, recipe: schemas.RecipeCreate, response: Response, if_match: Optional[str] = Header(None)):
+    try:
+        updated_recipe = sheets.db.update_recipe(recipe_id, recipe, expected_versions=parse_if_match(if_match))
+    except sheets.VersionConflict:
+        raise HTTPException(status_code=412, detail="Recipe was modified by someone else")
     if updated_recipe is None:
         raise HTTPException(status_code=404, detail="Recipe not found")
+    response.headers["ETag"] = f'"{updated_recipe.version}"'
     return updated_recipe
 
 # History Endpoints
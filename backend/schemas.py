@@ -16,6 +16,7 @@ class IngredientCreate(IngredientBase):
 
 class Ingredient(IngredientBase):
     id: int
+    version: Optional[str] = None # Content hash, sent back as If-Match on update
     
     class Config:
         orm_mode = True
@@ -51,6 +52,7 @@ class Recipe(RecipeBase):
     id: int
     items: List[RecipeItem] = []
     total_cost: float # Calculated field
+    version: Optional[str] = None # Content hash, sent back as If-Match on update
 
     class Config:
         orm_mode = True
@@ -1,8 +1,11 @@
 import gspread
 from google.oauth2.service_account import Credentials
-from typing import List, Optional
+from typing import List, Optional, Set
 import os
 import json
+import hashlib
+import contextlib
+import threading
 from . import schemas
 
 # Scope validation
@@ -15,6 +18,14 @@ CREDENTIALS_FILE = "backend/service-account.json"
 # User provided ID
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "1trywo0xqOflaSLDUV0n8tuGqDguGmaMsfYmo31VuaVs")
 
+# Local snapshot of the cached worksheet records, used to answer reads right after a cold start
+SNAPSHOT_FILE = os.getenv("SHEETS_SNAPSHOT_FILE", "backend/sheets_snapshot.json")
+SNAPSHOT_FORMAT = 1
+# Worksheets whose records are kept in memory (and in the snapshot)
+CACHED_SHEETS = ["ingredients", "recipes", "recipe_items"]
+# Seconds between revision checks, so edits made directly in the spreadsheet are picked up
+RECONCILE_INTERVAL = float(os.getenv("SHEETS_RECONCILE_INTERVAL", "60"))
+
 def get_db_connection():
     # Priority 1: Environment Variable (for Render)
     google_creds_json = os.getenv("GOOGLE_CREDENTIALS_JSON")
@@ -56,13 +67,63 @@ def get_spreadsheet(client):
         sh.add_worksheet(title="recipe_items", rows=1000, cols=10)
         return sh
 
+class VersionConflict(Exception):
+    """Raised when an update's expected version no longer matches the stored entity"""
+    pass
+
 # --- CRUD Operations ---
 
 class SheetsCRUD:
     def __init__(self):
-        self.client = get_db_connection()
-        if self.client:
-            self.sh = get_spreadsheet(self.client)
+        # In-memory cache of raw worksheet records, keyed by worksheet title
+        self.cache = {}
+        # Spreadsheet revision (Drive modifiedTime) the cache was taken at
+        self.revision = None
+        self.client = None
+        self._snapshot_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+
+        # Bumped on every invalidation so a slow fetch can't overwrite fresher cache state
+        self._cache_generation = 0
+        # Guards cache, revision, generation and the write counters below
+        self._cache_lock = threading.Lock()
+        # Writes to cached sheets that have started / are still running, see _writing
+        self._writes_started = 0
+        self._writes_in_flight = 0
+        # Locks keyed by ("recipe", id), ("ingredient", id) or ("sheet", title); created on first use
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        # Highest id handed out per worksheet, so concurrent creates never reuse an id
+        self._last_ids = {}
+
+        # Serve reads from the last snapshot while we connect and reconcile in the background
+        self._load_snapshot()
+        self._thread = threading.Thread(target=self._start, daemon=True)
+        self._thread.start()
+
+    def _start(self):
+        try:
+            self._connect()
+            if self.client:
+                self._reconcile()
+        except Exception as e:
+            print(f"Error during background startup: {e}")
+        finally:
+            self._ready.set()
+
+        if not self.client:
+            return
+        while not self._stop.wait(RECONCILE_INTERVAL):
+            try:
+                self._reconcile()
+            except Exception as e:
+                print(f"Error during background reconcile: {e}")
+
+    def _connect(self):
+        client = get_db_connection()
+        if client:
+            self.sh = get_spreadsheet(client)
             self.recipe_ws = self._get_or_create_worksheet("recipes", ["id", "name", "description", "selling_price", "updated_at"])
             # Updated to include new columns
             self.ing_ws = self._get_or_create_worksheet("ingredients", ["id", "name", "price", "amount", "unit", "updated_at", "tax_type", "tax_rate"])
@@ -70,9 +131,150 @@ class SheetsCRUD:
             # History Worksheets
             self.ing_history_ws = self._get_or_create_worksheet("ingredients_history", ["id", "ingredient_id", "name", "price", "amount", "unit", "updated_at", "tax_type", "tax_rate", "changed_at"])
             self.recipe_history_ws = self._get_or_create_worksheet("recipes_history", ["id", "recipe_id", "name", "description", "selling_price", "updated_at", "items_snapshot", "total_cost", "changed_at"])
-            
-            # Simple in-memory cache
-            self.cache = {}
+
+            self.worksheets = {
+                "ingredients": self.ing_ws,
+                "recipes": self.recipe_ws,
+                "recipe_items": self.recipe_item_ws,
+            }
+            # Only publish the client once all worksheets are ready
+            self.client = client
+
+    def close(self):
+        """Stop the background reconcile loop"""
+        self._stop.set()
+
+    def wait_until_connected(self, timeout=None):
+        """Block until the background connection attempt has finished"""
+        self._ready.wait(timeout)
+        return self.client is not None
+
+    # --- Snapshot ---
+
+    def _load_snapshot(self):
+        if not os.path.exists(SNAPSHOT_FILE):
+            return
+        try:
+            with open(SNAPSHOT_FILE) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable snapshot: {e}")
+            return
+
+        if snapshot.get("format") != SNAPSHOT_FORMAT or snapshot.get("spreadsheet_id") != SPREADSHEET_ID:
+            print("Ignoring snapshot from another spreadsheet or format")
+            return
+
+        self.cache = {k: v for k, v in snapshot.get("records", {}).items() if k in CACHED_SHEETS}
+        self.revision = snapshot.get("revision")
+        print(f"Loaded snapshot ({', '.join(self.cache) or 'empty'}) at revision {self.revision}")
+
+    def _save_snapshot(self):
+        tmp_file = SNAPSHOT_FILE + ".tmp"
+        # Copy and write under one lock so an older state can never overwrite a newer snapshot
+        with self._snapshot_lock:
+            with self._cache_lock:
+                snapshot = {
+                    "format": SNAPSHOT_FORMAT,
+                    "spreadsheet_id": SPREADSHEET_ID,
+                    "revision": self.revision,
+                    "records": dict(self.cache),
+                }
+            try:
+                with open(tmp_file, "w") as f:
+                    json.dump(snapshot, f, separators=(",", ":"), default=str)
+                # Atomic replace so a crash never leaves a half-written snapshot
+                os.replace(tmp_file, SNAPSHOT_FILE)
+            except OSError as e:
+                print(f"Could not write snapshot: {e}")
+
+    def _get_revision(self):
+        try:
+            return self.sh.get_lastUpdateTime()
+        except Exception as e:
+            print(f"Could not read spreadsheet revision: {e}")
+            return None
+
+    def _reconcile(self):
+        """Reload every cached worksheet unless the cache is still current"""
+        with self._cache_lock:
+            generation = self._cache_generation
+        revision = self._get_revision()
+        with self._cache_lock:
+            current = revision is not None and revision == self.revision
+            missing = [name for name in CACHED_SHEETS if name not in self.cache or not current]
+            if not current:
+                print(f"Cache is stale ({self.revision} -> {revision}), reloading")
+        if not missing:
+            return
+
+        records = {name: self.worksheets[name].get_all_records() for name in missing}
+        with self._cache_lock:
+            # A write ran while we were fetching; leave it to the next reconcile
+            if generation != self._cache_generation or self._writes_in_flight:
+                return
+            self.cache.update(records)
+            self._cache_generation += 1
+            self.revision = revision
+        self._save_snapshot()
+
+    def _get_records(self, name):
+        """Raw records of a cached worksheet, fetched from the sheet on a cache miss"""
+        with self._cache_lock:
+            if name in self.cache:
+                return self.cache[name]
+            generation = self._cache_generation
+        if not self.wait_until_connected():
+            return []
+        records = self.worksheets[name].get_all_records()
+        with self._cache_lock:
+            # A write landed while we were fetching; serve what we got but don't cache it
+            if generation != self._cache_generation:
+                return records
+            self.cache[name] = records
+        self._save_snapshot()
+        return records
+
+    @contextlib.contextmanager
+    def _writing(self, *names):
+        """Wrap a write to the given cached worksheets; they are invalidated even if the write fails"""
+        with self._cache_lock:
+            self._writes_started += 1
+            self._writes_in_flight += 1
+            ticket = self._writes_started
+        revision_before = self._get_revision()
+        try:
+            yield
+        finally:
+            self._invalidate(ticket, revision_before, *names)
+
+    def _invalidate(self, ticket, revision_before, *names):
+        """Drop worksheets we just wrote to and persist the remaining cache.
+
+        `revision_before` is the spreadsheet revision read right before the write.
+        """
+        with self._cache_lock:
+            for name in names:
+                self.cache.pop(name, None)
+            self._cache_generation += 1
+            self._writes_in_flight -= 1
+            generation = self._cache_generation
+            # Our own write bumped the revision. The new one can only be trusted if the cache was
+            # current before the write and no other write overlapped it; otherwise force a full reload.
+            trusted = (revision_before is not None and revision_before == self.revision
+                       and self._writes_in_flight == 0 and self._writes_started == ticket)
+            if not trusted:
+                self.revision = None
+
+        if trusted:
+            revision_after = self._get_revision()
+            with self._cache_lock:
+                # Nothing else may have started or landed while we read the new revision
+                if revision_after is not None and generation == self._cache_generation and self._writes_started == ticket:
+                    self.revision = revision_after
+                else:
+                    self.revision = None
+        self._save_snapshot()
 
     def _get_or_create_worksheet(self, title, headers):
         try:
@@ -92,10 +294,37 @@ class SheetsCRUD:
             ws.append_row(headers)
         return ws
 
-    def _get_next_id(self, worksheet):
-        # Simple ID generation: count rows
-        # Row 1 is header.
-        return len(worksheet.get_all_values()) 
+    def _lock(self, kind, key):
+        """Lock for a single entity or worksheet, so writes to different entities run in parallel"""
+        with self._locks_guard:
+            return self._locks.setdefault((kind, key), threading.Lock())
+
+    def _get_next_id(self, worksheet, count=1):
+        """Reserve `count` consecutive ids in `worksheet` and return the first one"""
+        with self._lock("sheet", worksheet.title):
+            # Row 1 is header. Use the highest id rather than the row count since rows get deleted.
+            ids = [int(v) for v in worksheet.col_values(1)[1:] if str(v).isdigit()]
+            new_id = max(ids + [self._last_ids.get(worksheet.title, 0)]) + 1
+            self._last_ids[worksheet.title] = new_id + count - 1
+            return new_id
+
+    def _version(self, data):
+        """Short content hash used as the entity's ETag"""
+        payload = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+    def _ingredient_version(self, ingredient: schemas.Ingredient):
+        return self._version(ingredient.dict(exclude={'version'}))
+
+    def _recipe_version(self, recipe: schemas.Recipe):
+        # Only the recipe's own fields; ingredient price changes don't conflict with recipe edits
+        return self._version({
+            'name': recipe.name,
+            'description': recipe.description,
+            'selling_price': recipe.selling_price,
+            'updated_at': recipe.updated_at,
+            'items': [[i.ingredient_id, i.amount, i.section] for i in recipe.items],
+        })
 
     # Ingredients
     # Ingredients
@@ -110,39 +339,46 @@ class SheetsCRUD:
         return r
 
     def get_ingredients(self):
-        if not self.client: return []
-        
-        # Check cache
-        if 'ingredients' in self.cache:
-            print("Serving ingredients from cache")
-            return self.cache['ingredients']
-            
-        records = self.ing_ws.get_all_records()
-        result = [schemas.Ingredient(**self._clean_ingredient_record(r)) for r in records]
-        
-        # Update cache
-        self.cache['ingredients'] = result
+        records = self._get_records('ingredients')
+        result = []
+        for r in records:
+            ingredient = schemas.Ingredient(**self._clean_ingredient_record(r))
+            ingredient.version = self._ingredient_version(ingredient)
+            result.append(ingredient)
         return result
 
+    def get_ingredient(self, ingredient_id: int):
+        for i in self.get_ingredients():
+            if i.id == ingredient_id:
+                return i
+        return None
+
     def create_ingredient(self, ing: schemas.IngredientCreate):
-        if not self.client: raise Exception("DB not connected")
+        if not self.wait_until_connected(): raise Exception("DB not connected")
         new_id = self._get_next_id(self.ing_ws)
         row = [new_id, ing.name, ing.price, ing.amount, ing.unit, ing.updated_at, ing.tax_type, ing.tax_rate]
-        self.ing_ws.append_row(row)
-        # Invalidate cache
-        if 'ingredients' in self.cache:
-            del self.cache['ingredients']
-            
-        return schemas.Ingredient(id=new_id, **ing.dict())
+        with self._writing('ingredients'):
+            self.ing_ws.append_row(row)
 
-    def update_ingredient(self, ingredient_id: int, ing: schemas.IngredientCreate):
-        if not self.client: raise Exception("DB not connected")
-        
+        # Re-fetch so the version matches what later reads of the stored row produce
+        return self.get_ingredient(new_id)
+
+    def update_ingredient(self, ingredient_id: int, ing: schemas.IngredientCreate, expected_versions: Optional[Set[str]] = None):
+        if not self.wait_until_connected(): raise Exception("DB not connected")
+        with self._lock("ingredient", ingredient_id):
+            return self._update_ingredient(ingredient_id, ing, expected_versions)
+
+    def _update_ingredient(self, ingredient_id: int, ing: schemas.IngredientCreate, expected_versions: Optional[Set[str]]):
         # Find row by ID (column 1)
         try:
             cell = self.ing_ws.find(str(ingredient_id), in_column=1)
         except gspread.exceptions.CellNotFound:
             return None
+
+        if expected_versions is not None:
+            current = self.get_ingredient(ingredient_id)
+            if current is None or current.version not in expected_versions:
+                raise VersionConflict(f"Ingredient {ingredient_id} was modified")
             
         row_num = cell.row
         
@@ -170,21 +406,18 @@ class SheetsCRUD:
             current_data.get('tax_rate'),
             now # changed_at
         ]
-        self.ing_history_ws.append_row(history_row)
-
-        # 2. Update columns B to H (2 to 8)
-        # name, price, amount, unit, updated_at, tax_type, tax_rate
-        self.ing_ws.update(range_name=f'B{row_num}:H{row_num}', values=[[ing.name, ing.price, ing.amount, ing.unit, ing.updated_at, ing.tax_type, ing.tax_rate]])
+        with self._writing('ingredients'):
+            self.ing_history_ws.append_row(history_row)
 
-        
-        # Invalidate cache
-        if 'ingredients' in self.cache:
-            del self.cache['ingredients']
+            # 2. Update columns B to H (2 to 8)
+            # name, price, amount, unit, updated_at, tax_type, tax_rate
+            self.ing_ws.update(range_name=f'B{row_num}:H{row_num}', values=[[ing.name, ing.price, ing.amount, ing.unit, ing.updated_at, ing.tax_type, ing.tax_rate]])
 
-        return schemas.Ingredient(id=ingredient_id, **ing.dict())
+        # Re-fetch so the version matches what later reads of the stored row produce
+        return self.get_ingredient(ingredient_id)
 
     def get_ingredient_history(self, ingredient_id: int):
-        if not self.client: return []
+        if not self.wait_until_connected(): return []
         records = self.ing_history_ws.get_all_records()
         # Filter by ingredient_id
         history = [r for r in records if str(r['ingredient_id']) == str(ingredient_id)]
@@ -194,11 +427,10 @@ class SheetsCRUD:
 
     # Recipes
     def get_recipes(self):
-        if not self.client: return []
         # Get all data
-        r_records = self.recipe_ws.get_all_records()
-        i_records = self.ing_ws.get_all_records()
-        ri_records = self.recipe_item_ws.get_all_records()
+        r_records = self._get_records('recipes')
+        i_records = self._get_records('ingredients')
+        ri_records = self._get_records('recipe_items')
         
         # Build lookup dicts (Clean ingredient records first)
         ing_map = {r['id']: self._clean_ingredient_record(r) for r in i_records}
@@ -241,7 +473,7 @@ class SheetsCRUD:
                     ))
             
             # Construct Recipe object
-            results.append(schemas.Recipe(
+            recipe = schemas.Recipe(
                 id=recipe_id,
                 name=r['name'],
                 description=r.get('description'),
@@ -249,34 +481,36 @@ class SheetsCRUD:
                 updated_at=r.get('updated_at'),
                 items=items,
                 total_cost=total_cost
-            ))
+            )
+            recipe.version = self._recipe_version(recipe)
+            results.append(recipe)
         return results
 
     def create_recipe(self, recipe: schemas.RecipeCreate):
-        if not self.client: raise Exception("DB not connected")
+        if not self.wait_until_connected(): raise Exception("DB not connected")
         
         # 1. Create Recipe
         new_r_id = self._get_next_id(self.recipe_ws)
-        self.recipe_ws.append_row([new_r_id, recipe.name, recipe.description, recipe.selling_price, recipe.updated_at])
-        
-        # 2. Create Recipe Items
-        created_items = []
-        # Need to fetch ingredients for full response, but for now we skip that or fetch
-        
-        for item in recipe.items:
-            new_ri_id = self._get_next_id(self.recipe_item_ws) + len(created_items) # offset
-            self.recipe_item_ws.append_row([
-                new_ri_id,
-                new_r_id,
-                item.ingredient_id,
-                item.amount,
-                item.section
-            ])
-            # For response, we'd need to reconstruct objects. 
-            # Doing a full fetch is eager but easiest for compliance with schema.
+        with self._writing('recipes', 'recipe_items'):
+            self.recipe_ws.append_row([new_r_id, recipe.name, recipe.description, recipe.selling_price, recipe.updated_at])
+
+            # 2. Create Recipe Items
+            self._append_recipe_items(new_r_id, recipe.items)
+        # For response, we'd need to reconstruct objects. 
+        # Doing a full fetch is eager but easiest for compliance with schema.
             
         return self.get_recipe(new_r_id) # Re-fetch to return full object
 
+    def _append_recipe_items(self, recipe_id: int, items: List[schemas.RecipeItemCreate]):
+        if not items:
+            return
+        # Reserve all ids up front and write in one call so concurrent writers can't interleave rows
+        first_id = self._get_next_id(self.recipe_item_ws, count=len(items))
+        self.recipe_item_ws.append_rows([
+            [first_id + i, recipe_id, item.ingredient_id, item.amount, item.section]
+            for i, item in enumerate(items)
+        ])
+
     def get_recipe(self, recipe_id: int):
         recipes = self.get_recipes()
         for r in recipes:
@@ -284,13 +518,18 @@ class SheetsCRUD:
                 return r
         return None
 
-    def update_recipe(self, recipe_id: int, recipe: schemas.RecipeCreate):
-        if not self.client: raise Exception("DB not connected")
-        
+    def update_recipe(self, recipe_id: int, recipe: schemas.RecipeCreate, expected_versions: Optional[Set[str]] = None):
+        if not self.wait_until_connected(): raise Exception("DB not connected")
+        with self._lock("recipe", recipe_id):
+            return self._update_recipe(recipe_id, recipe, expected_versions)
+
+    def _update_recipe(self, recipe_id: int, recipe: schemas.RecipeCreate, expected_versions: Optional[Set[str]]):
         # 1. Get current recipe state for history
         current_recipe = self.get_recipe(recipe_id)
         if not current_recipe:
             return None
+        if expected_versions is not None and current_recipe.version not in expected_versions:
+            raise VersionConflict(f"Recipe {recipe_id} was modified")
 
         # 2. Save to history
         history_id = self._get_next_id(self.recipe_history_ws)
@@ -314,60 +553,54 @@ class SheetsCRUD:
             current_recipe.total_cost,
             now
         ]
-        self.recipe_history_ws.append_row(history_row)
-        
-        # 3. Update Recipe Row
-        try:
-            cell = self.recipe_ws.find(str(recipe_id), in_column=1)
-        except gspread.exceptions.CellNotFound:
-            return None
+        with self._writing('recipes', 'recipe_items'):
+            self.recipe_history_ws.append_row(history_row)
         
-        row_num = cell.row
-        # Update basic info: name, description, selling_price, updated_at
-        self.recipe_ws.update(range_name=f'B{row_num}:E{row_num}', values=[[recipe.name, recipe.description, recipe.selling_price, recipe.updated_at]])
+            # 3. Update Recipe Row
+            try:
+                cell = self.recipe_ws.find(str(recipe_id), in_column=1)
+            except gspread.exceptions.CellNotFound:
+                return None
         
-        # 4. Update Recipe Items
-        # Strategy: Delete old items for this recipe and create new ones.
-        # This is inefficient for sheets but simplest to implement without complex diffing.
+            row_num = cell.row
+            # Update basic info: name, description, selling_price, updated_at
+            self.recipe_ws.update(range_name=f'B{row_num}:E{row_num}', values=[[recipe.name, recipe.description, recipe.selling_price, recipe.updated_at]])
         
-        # Find all items with this recipe_id
-        # We need to find rows where col 2 (recipe_id) == recipe_id
-        # "Batch delete" or "Overwrite"
-        # Since we don't have good batch delete in gspread without row indices, let's try:
-        # Get all records, filter out this recipe's items, then clear sheet and write back? TOO RISKY/SLOW.
-        # Better: Just append new items and ignore old/orphaned ones in `get_recipes`? 
-        # No, `get_recipes` fetches ALL. We must clean up.
+            # 4. Update Recipe Items
+            # Strategy: Delete old items for this recipe and create new ones.
+            # This is inefficient for sheets but simplest to implement without complex diffing.
         
-        # Alternative: Re-implement `get_recipes` to filter out deleted? No field for that.
+            # Find all items with this recipe_id
+            # We need to find rows where col 2 (recipe_id) == recipe_id
+            # "Batch delete" or "Overwrite"
+            # Since we don't have good batch delete in gspread without row indices, let's try:
+            # Get all records, filter out this recipe's items, then clear sheet and write back? TOO RISKY/SLOW.
+            # Better: Just append new items and ignore old/orphaned ones in `get_recipes`? 
+            # No, `get_recipes` fetches ALL. We must clean up.
         
-        # Let's do: Find keys of items to delete.
-        all_items = self.recipe_item_ws.get_all_records()
-        rows_to_delete = []
-        # get_all_records returns dict list, we need row numbers. 
-        # `findall` might work but only for specific value.
+            # Alternative: Re-implement `get_recipes` to filter out deleted? No field for that.
         
-        cell_list = self.recipe_item_ws.findall(str(recipe_id), in_column=2)
-        # Delete from bottom to top to preserve indices
-        rows_to_delete = sorted([c.row for c in cell_list], reverse=True)
-        
-        for r_idx in rows_to_delete:
-            self.recipe_item_ws.delete_rows(r_idx)
+            # Let's do: Find keys of items to delete.
+            # get_all_records returns dict list, we need row numbers. 
+            # `findall` works since we only match a specific value.
+
+            # Row indices shift when any recipe's items are deleted, so the find + delete
+            # must not interleave with another recipe doing the same on this sheet.
+            with self._lock("sheet", self.recipe_item_ws.title):
+                cell_list = self.recipe_item_ws.findall(str(recipe_id), in_column=2)
+                # Delete from bottom to top to preserve indices
+                rows_to_delete = sorted([c.row for c in cell_list], reverse=True)
+
+                for r_idx in rows_to_delete:
+                    self.recipe_item_ws.delete_rows(r_idx)
             
-        # Add new items
-        for item in recipe.items:
-            new_ri_id = self._get_next_id(self.recipe_item_ws)
-            self.recipe_item_ws.append_row([
-                new_ri_id,
-                recipe_id,
-                item.ingredient_id,
-                item.amount,
-                item.section
-            ])
+            # Add new items
+            self._append_recipe_items(recipe_id, recipe.items)
             
         return self.get_recipe(recipe_id)
 
     def get_recipe_history(self, recipe_id: int):
-        if not self.client: return []
+        if not self.wait_until_connected(): return []
         records = self.recipe_history_ws.get_all_records()
         history = [r for r in records if str(r['recipe_id']) == str(recipe_id)]
         history.sort(key=lambda x: x['changed_at'], reverse=True)
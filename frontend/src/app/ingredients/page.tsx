@@ -14,6 +14,7 @@ type Ingredient = {
     updated_at: string;
     tax_type: string;
     tax_rate: number;
+    version?: string;
 };
 
 type IngredientHistory = Ingredient & {
@@ -34,6 +35,7 @@ export default function IngredientsPage() {
     });
     const [isFormOpen, setIsFormOpen] = useState(false);
     const [editingId, setEditingId] = useState<number | null>(null);
+    const [editingVersion, setEditingVersion] = useState<string | null>(null);
     const [history, setHistory] = useState<IngredientHistory[]>([]);
     const [showHistory, setShowHistory] = useState(false);
     const [isLoading, setIsLoading] = useState(true);
@@ -88,7 +90,10 @@ export default function IngredientsPage() {
             };
 
             if (editingId) {
-                await axios.put(`${API_URL}/ingredients/${editingId}`, submitData);
+                await axios.put(`${API_URL}/ingredients/${editingId}`, submitData, {
+                    // Reject the save if someone else changed the ingredient since we loaded it
+                    headers: editingVersion ? { "If-Match": `"${editingVersion}"` } : {}
+                });
             } else {
                 await axios.post(`${API_URL}/ingredients/`, submitData);
             }
@@ -98,6 +103,10 @@ export default function IngredientsPage() {
             setIsFormOpen(false);
         } catch (error) {
             console.error("Error saving ingredient:", error);
+            if (axios.isAxiosError(error) && error.response?.status === 412) {
+                alert("他の人がこの材料を更新しました。再読み込みしてください");
+                return;
+            }
             alert("エラーが発生しました。入力を確認してください。");
         }
     };
@@ -113,12 +122,14 @@ export default function IngredientsPage() {
             tax_rate: 8
         });
         setEditingId(null);
+        setEditingVersion(null);
         setHistory([]);
         setShowHistory(false);
     };
 
     const handleEdit = (ing: Ingredient) => {
         setEditingId(ing.id);
+        setEditingVersion(ing.version || null);
         setFormData({
             name: ing.name,
             price: ing.price.toString(),
@@ -33,6 +33,7 @@ export default function EditRecipePage() {
     const [sellingPrice, setSellingPrice] = useState("");
     const [updatedAt, setUpdatedAt] = useState(new Date().toISOString().split('T')[0]);
     const [items, setItems] = useState<RecipeItemInput[]>([]);
+    const [version, setVersion] = useState<string | null>(null);
     const [loading, setLoading] = useState(true);
 
     // Modal state
@@ -57,6 +58,7 @@ export default function EditRecipePage() {
                     setRecipeName(recipe.name);
                     setSellingPrice(recipe.selling_price?.toString() || "");
                     setUpdatedAt(recipe.updated_at || new Date().toISOString().split('T')[0]);
+                    setVersion(recipe.version || null);
 
                     // Map items
                     const mappedItems = recipe.items.map((item: any) => {
@@ -136,10 +138,17 @@ export default function EditRecipePage() {
                     amount: i.amount,
                     section: i.section
                 }))
+            }, {
+                // Reject the save if someone else changed the recipe since we loaded it
+                headers: version ? { "If-Match": `"${version}"` } : {}
             });
             router.push(`/recipes/${recipeId}`);
         } catch (error) {
             console.error("Failed to update recipe", error);
+            if (axios.isAxiosError(error) && error.response?.status === 412) {
+                alert("他の人がこのレシピを更新しました。再読み込みしてください");
+                return;
+            }
             alert("保存に失敗しました");
         }
     };
@@ -0,0 +1,378 @@
+"""Contention stress test for SheetsCRUD against an in-memory fake spreadsheet.
+
+Run with: python -m pytest test_concurrency.py
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Keep the snapshot of the module-level singleton out of the working tree
+os.environ.setdefault("SHEETS_SNAPSHOT_FILE", os.path.join(tempfile.mkdtemp(), "snapshot.json"))
+
+import gspread
+import pytest
+
+from backend import schemas, sheets
+
+
+class FakeCell:
+    def __init__(self, row):
+        self.row = row
+
+
+class FakeWorksheet:
+    """Just enough of gspread.Worksheet; each call is atomic, like a single API request"""
+
+    def __init__(self, title, spreadsheet):
+        self.title = title
+        self.spreadsheet = spreadsheet
+        self.rows = []
+        self.lock = threading.Lock()
+        self.full_reads = 0
+
+    def _latency(self):
+        # Give other threads a chance to run between API calls
+        time.sleep(0.001)
+
+    def row_values(self, row):
+        self._latency()
+        with self.lock:
+            return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col):
+        self._latency()
+        with self.lock:
+            return [r[col - 1] if len(r) >= col else "" for r in self.rows]
+
+    def get_all_values(self):
+        self._latency()
+        with self.lock:
+            return [list(r) for r in self.rows]
+
+    def get_all_records(self):
+        self._latency()
+        with self.lock:
+            self.full_reads += 1
+            headers = self.rows[0]
+            return [dict(zip(headers, [gspread.utils.numericise(v) for v in r])) for r in self.rows[1:]]
+
+    def append_row(self, row):
+        self.append_rows([row])
+
+    def append_rows(self, rows):
+        self._latency()
+        with self.lock:
+            self.rows.extend(["" if v is None else str(v) for v in row] for row in rows)
+            self.spreadsheet.touch()
+
+    def find(self, query, in_column):
+        self._latency()
+        with self.lock:
+            for i, r in enumerate(self.rows):
+                if r[in_column - 1] == query:
+                    return FakeCell(i + 1)
+        raise gspread.exceptions.CellNotFound(query)
+
+    def findall(self, query, in_column):
+        self._latency()
+        with self.lock:
+            return [FakeCell(i + 1) for i, r in enumerate(self.rows) if r[in_column - 1] == query]
+
+    def delete_rows(self, index):
+        self._latency()
+        with self.lock:
+            del self.rows[index - 1]
+            self.spreadsheet.touch()
+
+    def update(self, range_name, values):
+        self._latency()
+        start_col, row = re.match(r"([A-Z])(\d+):", range_name).groups()
+        start = ord(start_col) - ord("A")
+        with self.lock:
+            target = self.rows[int(row) - 1]
+            target.extend([""] * (start + len(values[0]) - len(target)))
+            target[start:start + len(values[0])] = ["" if v is None else str(v) for v in values[0]]
+            self.spreadsheet.touch()
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.worksheets = {}
+        # Like Drive's modifiedTime: bumped by every write, whether through the API or not
+        self.revision = 0
+        self.lock = threading.Lock()
+
+    def touch(self):
+        with self.lock:
+            self.revision += 1
+
+    def worksheet(self, title):
+        if title not in self.worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self.worksheets[title] = FakeWorksheet(title, self)
+        return self.worksheets[title]
+
+    def get_lastUpdateTime(self):
+        return str(self.revision)
+
+
+@pytest.fixture
+def spreadsheet(monkeypatch, tmp_path):
+    """Point every SheetsCRUD built in the test at one fake spreadsheet and a private snapshot file"""
+    sh = FakeSpreadsheet()
+    monkeypatch.setattr(sheets, "SNAPSHOT_FILE", str(tmp_path / "snapshot.json"))
+    monkeypatch.setattr(sheets, "get_db_connection", lambda: object())
+    monkeypatch.setattr(sheets, "get_spreadsheet", lambda client: sh)
+    return sh
+
+
+@pytest.fixture
+def make_db(spreadsheet):
+    """Build SheetsCRUD instances and stop their background threads after the test"""
+    created = []
+
+    def make():
+        crud = sheets.SheetsCRUD()
+        created.append(crud)
+        return crud
+
+    yield make
+    for crud in created:
+        crud.close()
+
+
+@pytest.fixture
+def db(make_db):
+    crud = make_db()
+    assert crud.wait_until_connected(timeout=10)
+    return crud
+
+
+def make_ingredients(db, count):
+    return [
+        db.create_ingredient(schemas.IngredientCreate(name=f"ing{i}", price=100, amount=1000, unit="g"))
+        for i in range(count)
+    ]
+
+
+def recipe_with(name, ingredients, amount):
+    return schemas.RecipeCreate(
+        name=name,
+        items=[schemas.RecipeItemCreate(ingredient_id=i.id, amount=amount) for i in ingredients],
+    )
+
+
+def test_concurrent_creates_get_unique_ids(db):
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        created = list(pool.map(
+            lambda i: db.create_ingredient(schemas.IngredientCreate(name=f"ing{i}", price=1, amount=1, unit="g")),
+            range(40),
+        ))
+
+    assert sorted(ing.id for ing in created) == list(range(1, 41))
+    assert sorted(ing.id for ing in db.get_ingredients()) == list(range(1, 41))
+
+
+def test_concurrent_recipe_updates_keep_items_consistent(db):
+    ingredients = make_ingredients(db, 3)
+    recipes = [db.create_recipe(recipe_with(f"r{i}", ingredients, 1)) for i in range(6)]
+
+    def update(args):
+        recipe, round_no = args
+        # Alternate between 1 and 3 items so lost or duplicated deletes show up in the counts
+        items = ingredients if round_no % 2 else ingredients[:1]
+        db.update_recipe(recipe.id, recipe_with(recipe.name, items, round_no))
+
+    jobs = [(r, n) for n in range(6) for r in recipes]
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        list(pool.map(update, jobs))
+
+    item_ids = []
+    for recipe in db.get_recipes():
+        # Rounds race each other, but the result must be exactly one of them: never a mix
+        amounts = [item.amount for item in recipe.items]
+        round_no = int(amounts[0])
+        assert amounts == [round_no] * (3 if round_no % 2 else 1)
+        item_ids += [item.id for item in recipe.items]
+    assert len(item_ids) == len(set(item_ids))
+
+
+def test_update_with_stale_version_is_rejected(db):
+    ingredients = make_ingredients(db, 1)
+    recipe = db.create_recipe(recipe_with("bread", ingredients, 100))
+
+    updated = db.update_recipe(recipe.id, recipe_with("bread", ingredients, 200), expected_versions={recipe.version})
+    assert updated.version != recipe.version
+
+    with pytest.raises(sheets.VersionConflict):
+        db.update_recipe(recipe.id, recipe_with("bread", ingredients, 300), expected_versions={recipe.version})
+    assert db.get_recipe(recipe.id).items[0].amount == 200
+
+
+def test_ingredient_update_with_stale_version_is_rejected(db):
+    ingredient = make_ingredients(db, 1)[0]
+    # updated_at="" is stored as an empty cell and read back as None
+    change = schemas.IngredientCreate(name="flour", price=120, amount=1000, unit="g", updated_at="")
+
+    updated = db.update_ingredient(ingredient.id, change, expected_versions={ingredient.version})
+    assert updated.updated_at is None
+    assert updated.version == db.get_ingredients()[0].version
+    # The returned ETag is good for the next update
+    db.update_ingredient(ingredient.id, change, expected_versions={updated.version})
+
+    with pytest.raises(sheets.VersionConflict):
+        db.update_ingredient(ingredient.id, change, expected_versions={ingredient.version})
+
+
+def test_write_after_external_edit_forces_full_reload(db, spreadsheet):
+    make_ingredients(db, 1)
+    assert db.revision == str(spreadsheet.revision)
+
+    # Someone edits the spreadsheet directly, then we write through the API
+    spreadsheet.touch()
+    db.create_recipe(recipe_with("bread", [], 1))
+    assert db.revision is None
+
+
+def test_external_edit_is_picked_up_by_reconcile(db, spreadsheet):
+    assert db.get_ingredients() == []
+
+    # Add a row directly in the spreadsheet, bypassing the API
+    db.ing_ws.append_row([1, "flour", 100, 1000, "g", "", "inclusive", 0.08])
+    db._reconcile()
+    assert [ing.name for ing in db.get_ingredients()] == ["flour"]
+
+
+def test_close_stops_reconcile_loop(make_db, monkeypatch):
+    monkeypatch.setattr(sheets, "RECONCILE_INTERVAL", 0.01)
+    crud = make_db()
+    assert crud.wait_until_connected(timeout=10)
+
+    crud.close()
+    crud._thread.join(timeout=5)
+    assert not crud._thread.is_alive()
+
+
+def test_if_match_uses_strong_comparison():
+    from backend.main import parse_if_match
+
+    assert parse_if_match(None) is None
+    assert parse_if_match("*") is None
+    assert parse_if_match('"a", W/"b", "c"') == {"a", "c"}
+    assert parse_if_match('W/"a"') == set()
+
+
+def test_write_adopts_new_revision_and_restart_skips_reload(db, spreadsheet, make_db):
+    make_ingredients(db, 1)
+    db.get_recipes()
+    assert db.revision == str(spreadsheet.revision)
+
+    reads = spreadsheet.worksheets["ingredients"].full_reads
+    restarted = make_db()
+    assert restarted.wait_until_connected(timeout=10)
+    assert spreadsheet.worksheets["ingredients"].full_reads == reads
+    assert [ing.name for ing in restarted.get_ingredients()] == ["ing0"]
+
+
+def test_overlapping_writes_never_vouch_for_stale_cache(db, spreadsheet, make_db, monkeypatch):
+    ingredient = make_ingredients(db, 1)[0]
+    db.get_recipes()  # Cache every sheet at the current revision
+    recipes_ws, ing_ws = spreadsheet.worksheets["recipes"], spreadsheet.worksheets["ingredients"]
+    recipe_blocked, ingredient_written, recipe_done = threading.Event(), threading.Event(), threading.Event()
+
+    # The recipe write starts first but lands only after the ingredient change...
+    original_append_rows = recipes_ws.append_rows
+    def blocked_append_rows(rows):
+        recipe_blocked.set()
+        assert ingredient_written.wait(timeout=5)
+        original_append_rows(rows)
+    monkeypatch.setattr(recipes_ws, "append_rows", blocked_append_rows)
+
+    # ...and the ingredient write lands but only invalidates after the recipe write is done
+    original_update = ing_ws.update
+    def blocked_update(range_name, values):
+        original_update(range_name, values)
+        ingredient_written.set()
+        assert recipe_done.wait(timeout=5)
+    monkeypatch.setattr(ing_ws, "update", blocked_update)
+
+    change = schemas.IngredientCreate(name="ing0", price=999, amount=1000, unit="g")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        create = pool.submit(db.create_recipe, recipe_with("bread", [ingredient], 1))
+        assert recipe_blocked.wait(timeout=5)
+        update = pool.submit(db.update_ingredient, ingredient.id, change)
+        create.result(timeout=5)
+
+        # The sheet already holds price 999 but the cache doesn't, so the snapshot must not claim it is current
+        with open(sheets.SNAPSHOT_FILE) as f:
+            assert json.load(f)["revision"] is None
+        recipe_done.set()
+        update.result(timeout=5)
+
+    restarted = make_db()
+    assert restarted.wait_until_connected(timeout=10)
+    assert restarted.get_ingredient(ingredient.id).price == 999
+
+
+def test_failed_write_still_invalidates(db, spreadsheet, monkeypatch):
+    ingredients = make_ingredients(db, 2)
+    recipe = db.create_recipe(recipe_with("bread", ingredients, 1))
+
+    def broken_append_rows(rows):
+        raise RuntimeError("quota exceeded")
+    monkeypatch.setattr(spreadsheet.worksheets["recipe_items"], "append_rows", broken_append_rows)
+
+    with pytest.raises(RuntimeError):
+        db.update_recipe(recipe.id, recipe_with("bread", ingredients, 2))
+    # The old items were deleted before the failure; the cache must not keep serving them
+    assert "recipe_items" not in db.cache
+    assert db.get_recipe(recipe.id).items == []
+
+
+@pytest.fixture
+def blocked_connection(spreadsheet, monkeypatch):
+    """Hold every new SheetsCRUD in _connect until the returned event is set"""
+    gate = threading.Event()
+
+    def slow_connection():
+        gate.wait(timeout=10)
+        return object()
+    monkeypatch.setattr(sheets, "get_db_connection", slow_connection)
+    yield gate
+    gate.set()
+
+
+def test_snapshot_serves_reads_while_connecting(db, make_db, blocked_connection):
+    ingredient = make_ingredients(db, 1)[0]
+    db.create_recipe(recipe_with("bread", [ingredient], 100))
+
+    restarted = make_db()
+    assert restarted.client is None
+    assert restarted.revision == db.revision
+    assert restarted.cache == db.cache
+    assert [ing.name for ing in restarted.get_ingredients()] == ["ing0"]
+    assert [(r.name, r.total_cost) for r in restarted.get_recipes()] == [("bread", 10.0)]
+
+    blocked_connection.set()
+    assert restarted.wait_until_connected(timeout=10)
+
+
+@pytest.mark.parametrize("contents", [
+    json.dumps({"format": sheets.SNAPSHOT_FORMAT + 1, "spreadsheet_id": sheets.SPREADSHEET_ID, "revision": "1", "records": {"ingredients": []}}),
+    json.dumps({"format": sheets.SNAPSHOT_FORMAT, "spreadsheet_id": "another-sheet", "revision": "1", "records": {"ingredients": []}}),
+    "{not json",
+], ids=["wrong-format", "wrong-spreadsheet", "unreadable"])
+def test_unusable_snapshot_is_ignored(make_db, blocked_connection, contents):
+    with open(sheets.SNAPSHOT_FILE, "w") as f:
+        f.write(contents)
+
+    crud = make_db()
+    assert crud.cache == {}
+    assert crud.revision is None
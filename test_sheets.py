@@ -2,8 +2,7 @@ from backend.sheets import db
 
 try:
     print("Testing connection...")
-    cxn = db.client
-    if cxn:
+    if db.wait_until_connected(timeout=60):
         print("Client connected.")
         print(f"Opening spreadsheet: {db.sh.title}")
         print("Worksheets:", [ws.title for ws in db.sh.worksheets()])